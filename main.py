@@ -5,29 +5,48 @@
 # - CART MANAGER: view cart, remove items, clear cart, continue shopping
 # - Checkout applies FINAL = round(sum(base_prices) * 1.30 + 30, 2)
 # - Collect sender wallet + shipping
-# - Orders saved in SQLite (status=Pending)
+# - Orders saved in SQLite via a pooled aiosqlite connection (status=Pending)
 # - Admin group gets order card with inline status buttons
 # - Tickets: Contact Team + /reply
 # - /reload_eu to reload spreadsheet
+# - Long polling by default; webhook mode when WEBHOOK_HOST is set
 
 import os
 import re
+import sys
+import asyncio
+import logging
+import aiohttp
+from aiohttp import web
 import csv
-import sqlite3
-from io import StringIO
-from contextlib import closing
+import hashlib
+import hmac
+import zipfile
+import aiosqlite
+from io import BufferedReader, RawIOBase, TextIOWrapper
+from array import array
+from collections import namedtuple
+from functools import lru_cache
+from itertools import chain, count, repeat
+from time import monotonic
+from aiosqlitepool import SQLiteConnectionPool
+from cachetools import TTLCache
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
+from aiogram.utils.callback_data import CallbackData
+from aiogram.utils.exceptions import CantParseEntities, RetryAfter
 
 # Optional deps
-try:
-    import requests
-except Exception:
-    requests = None
 try:
     import openpyxl
 except Exception:
     openpyxl = None
+try:
+    from python_calamine import CalamineWorkbook
+except Exception:
+    CalamineWorkbook = None
+
+log = logging.getLogger(__name__)
 
 # ---- ENV ----
 API_TOKEN = os.getenv("API_TOKEN")
@@ -35,500 +54,1001 @@ ADMIN_GROUP_ID = int(os.getenv("ADMIN_GROUP_ID", "0"))
 WALLET_ADDRESS = os.getenv("WALLET_ADDRESS", "YOUR_USDT_WALLET")
 EU_PRICELIST_PATH = os.getenv("EU_PRICELIST_PATH")        # e.g. eu_pricelist.xlsx
 EU_PRICELIST_CSV_URL = os.getenv("EU_PRICELIST_CSV_URL")  # optional
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")                  # e.g. https://shop.example.com; unset = long polling
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")              # optional; A-Z a-z 0-9 _ - only
 
 if not API_TOKEN: raise ValueError("API_TOKEN not set")
 if not ADMIN_GROUP_ID: raise ValueError("ADMIN_GROUP_ID not set")
 
+# Unguessable path, plus the secret Telegram echoes in X-Telegram-Bot-Api-Secret-Token on
+# every webhook call; both default to values derived from the token so they survive restarts.
+WEBHOOK_PATH = "/webhook/" + hashlib.sha256(API_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_SECRET = WEBHOOK_SECRET or hashlib.sha256(b"webhook-secret:" + API_TOKEN.encode()).hexdigest()
+
 bot = Bot(token=API_TOKEN, parse_mode="Markdown")
 dp = Dispatcher(bot)
 
 DB_PATH = "orders.db"
 PAGE_SIZE = 10
+ORDERS_PAGE_SIZE = 5
 MARKUP_RATE = 0.30   # 30%
 SHIPPING_FEE = 30.0  # €30 flat
-ORDER_STATUSES = {"pending", "paid", "shipped", "delivered", "canceled"}
+ORDER_STATUSES = frozenset({"pending", "paid", "shipped", "delivered", "canceled"})
+STATUS_TITLES = {st: st.title() for st in ORDER_STATUSES}  # display form, e.g. "shipped" -> "Shipped"
+ORDER_ID_RE = re.compile(r"#(\d+)")
 
 # ---- DB ----
-def init_db():
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            region TEXT NOT NULL,
-            products TEXT NOT NULL,
-            total REAL NOT NULL,
-            user_wallet TEXT,
-            shipping TEXT,
-            status TEXT NOT NULL DEFAULT 'Pending',
-            created_at TEXT NOT NULL DEFAULT (datetime('now'))
-        )""")
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            text TEXT NOT NULL,
-            status TEXT NOT NULL DEFAULT 'open',
-            created_at TEXT NOT NULL DEFAULT (datetime('now')),
-            replied_at TEXT
-        )""")
-
-def insert_order(user_id, region, products_csv, final_total, user_wallet, shipping):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("""INSERT INTO orders (user_id, region, products, total, user_wallet, shipping)
-                     VALUES (?, ?, ?, ?, ?, ?)""",
-                  (user_id, region, products_csv, final_total, user_wallet, shipping))
-        return c.lastrowid
-
-def update_order_status(order_id, new_status):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("UPDATE orders SET status=? WHERE id=?", (new_status, order_id))
-        return c.rowcount
-
-def get_user_orders(user_id, limit=5):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        c = conn.cursor()
-        c.execute("""SELECT id, status, total, region, created_at
-                     FROM orders WHERE user_id=? ORDER BY id DESC LIMIT ?""",
-                  (user_id, limit))
-        return c.fetchall()
-
-def get_order(order_id):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        c = conn.cursor()
-        c.execute("""SELECT id, user_id, region, products, total, user_wallet, shipping, status, created_at
-                     FROM orders WHERE id=?""", (order_id,))
-        return c.fetchone()
-
-def insert_message(user_id, text):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO messages (user_id, text) VALUES (?, ?)", (user_id, text))
-        return c.lastrowid
-
-def get_message(msg_id):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        c = conn.cursor()
-        c.execute("SELECT id, user_id, text, status, created_at FROM messages WHERE id=?", (msg_id,))
-        return c.fetchone()
-
-def mark_message_replied(msg_id):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("UPDATE messages SET status='closed', replied_at=datetime('now') WHERE id=?", (msg_id,))
-        return c.rowcount
+SQL_CREATE_ORDERS = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    region TEXT NOT NULL,
+    products TEXT NOT NULL,
+    total REAL NOT NULL,
+    user_wallet TEXT,
+    shipping TEXT,
+    status TEXT NOT NULL DEFAULT 'Pending',
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    card_template TEXT
+)"""
+SQL_CREATE_MESSAGES = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open',
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    replied_at TEXT
+)"""
+# (user_id, id DESC) lets get_user_orders walk the index and stop after LIMIT rows; the trailing
+# columns cover SQL_USER_ORDERS so it never reads the wide order rows (products, shipping, card).
+SQL_INDEX_ORDERS_USER = """CREATE INDEX IF NOT EXISTS idx_orders_user_recent
+                           ON orders(user_id, id DESC, status, total, region, created_at)"""
+SQL_INDEX_MESSAGES_STATUS = "CREATE INDEX IF NOT EXISTS idx_messages_status ON messages(status)"
+
+# Statement text is kept constant so each pooled connection's statement cache reuses the prepared plan
+ORDER_COLUMNS = "id, user_id, region, products, total, user_wallet, shipping, status, created_at"
+# RETURNING yields the bound value before column affinity, so a whole-number total would
+# come back as int ("$69" on the first card, "$69.0" everywhere else); cast it back.
+SQL_INSERT_ORDER = """INSERT INTO orders (user_id, region, products, total, user_wallet, shipping, card_template)
+                      VALUES (?, ?, ?, ?, ?, ?, ?)
+                      RETURNING id, user_id, region, products, CAST(total AS REAL), user_wallet, shipping,
+                                status, created_at"""
+# The admin card is rendered once at insert; a status flip only substitutes {status}
+SQL_UPDATE_STATUS = "UPDATE orders SET status=? WHERE id=? RETURNING user_id, card_template"
+SQL_SET_CARD_TEMPLATE = "UPDATE orders SET card_template=? WHERE id=?"
+SQL_ORDER_TABLE_INFO = "PRAGMA table_info(orders)"
+SQL_ADD_CARD_TEMPLATE = "ALTER TABLE orders ADD COLUMN card_template TEXT"
+SQL_ALL_ORDERS = f"SELECT {ORDER_COLUMNS} FROM orders"
+# Keyset pagination: resume below the last id shown instead of OFFSET-scanning
+SQL_USER_ORDERS = """SELECT id, status, total, region, created_at
+                     FROM orders WHERE user_id=? AND (? IS NULL OR id < ?)
+                     ORDER BY id DESC LIMIT ?"""
+SQL_INSERT_MESSAGE = "INSERT INTO messages (user_id, text) VALUES (?, ?)"
+SQL_GET_MESSAGE = "SELECT id, user_id, text, status, created_at FROM messages WHERE id=?"
+SQL_MARK_REPLIED = "UPDATE messages SET status='closed', replied_at=datetime('now') WHERE id=?"
+
+# WAL lets status reads run alongside order writes; NORMAL fsyncs only at checkpoints.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+)
+
+# One pool of long-lived aiosqlite connections: each helper borrows a warm
+# connection (hot page cache, pragmas already applied) instead of reopening the file.
+async def _connect():
+    conn = await aiosqlite.connect(DB_PATH)
+    for pragma in SQLITE_PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+pool = SQLiteConnectionPool(_connect, pool_size=8)
+
+async def init_db():
+    async with pool.connection() as conn:
+        for sql in (SQL_CREATE_ORDERS, SQL_CREATE_MESSAGES, SQL_INDEX_ORDERS_USER, SQL_INDEX_MESSAGES_STATUS):
+            await conn.execute(sql)
+        await _migrate_card_template(conn)
+        await conn.execute("ANALYZE")
+        await conn.commit()
+
+async def _migrate_card_template(conn):
+    cur = await conn.execute(SQL_ORDER_TABLE_INFO)
+    if any(col[1] == "card_template" for col in await cur.fetchall()): return
+    await conn.execute(SQL_ADD_CARD_TEMPLATE)
+    cur = await conn.execute(SQL_ALL_ORDERS)
+    await conn.executemany(SQL_SET_CARD_TEMPLATE,
+                           [(order_card_template(*row[1:7]), row[0]) for row in await cur.fetchall()])
+
+async def insert_order(user_id, region, products_csv, final_total, user_wallet, shipping):
+    """Insert and return the new row as ORDER_COLUMNS, saving a re-read."""
+    card_template = order_card_template(user_id, region, products_csv, final_total, user_wallet, shipping)
+    async with pool.connection() as conn:
+        cur = await conn.execute(SQL_INSERT_ORDER, (user_id, region, products_csv, final_total,
+                                                    user_wallet, shipping, card_template))
+        row = await cur.fetchone()
+        await conn.commit()
+        return row
+
+async def update_order_status_returning(order_id, new_status):
+    """Set the status and return (rowcount, (user_id, card_template)) in one statement."""
+    async with pool.connection() as conn:
+        cur = await conn.execute(SQL_UPDATE_STATUS, (new_status, order_id))
+        row = await cur.fetchone()
+        await conn.commit()
+        return (1 if row else 0), row
+
+async def get_user_orders(user_id, limit=5, before_id=None):
+    async with pool.connection() as conn:
+        cur = await conn.execute(SQL_USER_ORDERS, (user_id, before_id, before_id, limit))
+        return await cur.fetchall()
+
+async def insert_message(user_id, text):
+    async with pool.connection() as conn:
+        cur = await conn.execute(SQL_INSERT_MESSAGE, (user_id, text))
+        await conn.commit()
+        return cur.lastrowid
+
+async def get_message(msg_id):
+    async with pool.connection() as conn:
+        cur = await conn.execute(SQL_GET_MESSAGE, (msg_id,))
+        return await cur.fetchone()
+
+async def mark_message_replied(msg_id):
+    async with pool.connection() as conn:
+        cur = await conn.execute(SQL_MARK_REPLIED, (msg_id,))
+        await conn.commit()
+        return cur.rowcount
 
 # ---- Catalogue / EU loader ----
-catalogues = {
-    "US": {1: {"name": "US Product 1", "price": 10.0, "stock": "In Stock"},
-           2: {"name": "US Product 2", "price": 20.0, "stock": "In Stock"},
-           3: {"name": "US Product 3", "price": 30.0, "stock": "In Stock"}},
-    "UK": {1: {"name": "UK Product 1", "price": 12.0, "stock": "In Stock"},
-           2: {"name": "UK Product 2", "price": 18.0, "stock": "In Stock"},
-           3: {"name": "UK Product 3", "price": 28.0, "stock": "In Stock"}},
-    "EU": {}
+# A region's catalogue is an immutable snapshot: loaders build a new one and swap it in
+# with a single assignment, so handlers can hold `cat = catalogues[region]` across awaits
+# (and parsing can run on a worker thread) without seeing a half-built catalogue.
+# Columns are stored as parallel arrays (SoA) in pid order; `index` maps pid -> position.
+Catalogue = namedtuple("Catalogue", ["index", "pids", "names", "prices", "in_stock", "labels", "version"])
+_catalogue_versions = count(1)
+
+class CatalogueBuilder:
+    """Collects parsed rows column-wise; a repeated pid overwrites its earlier row."""
+    __slots__ = ("pos", "pids", "names", "prices", "in_stock")
+
+    def __init__(self):
+        self.pos = {}
+        self.pids = []
+        self.names = []
+        self.prices = array("d")
+        self.in_stock = bytearray()
+
+    def __len__(self):
+        return len(self.pids)
+
+    def add(self, pid: int, name: str, price: float, in_stock: bool):
+        i = self.pos.get(pid)
+        if i is None:
+            self.pos[pid] = len(self.pids)
+            self.pids.append(pid); self.names.append(name)
+            self.prices.append(price); self.in_stock.append(in_stock)
+        else:
+            self.names[i] = name; self.prices[i] = price; self.in_stock[i] = in_stock
+
+    def build(self) -> Catalogue:
+        pids, names, prices, in_stock = self.pids, self.names, self.prices, self.in_stock
+        # Sheets almost always arrive in pid order; only pay for the sort when they don't
+        if any(a > b for a, b in zip(pids, pids[1:])):
+            order = sorted(range(len(pids)), key=pids.__getitem__)
+            pids = [pids[i] for i in order]; names = [names[i] for i in order]
+            prices = array("d", (prices[i] for i in order)); in_stock = bytearray(in_stock[i] for i in order)
+        labels = [f"{pid}. {name} ({'✅ In Stock' if ok else '❌ OOS'}) — ${price}"
+                  for pid, name, price, ok in zip(pids, names, prices, in_stock)]
+        index = {pid: i for i, pid in enumerate(pids)}
+        return Catalogue(index, pids, names, prices, in_stock, labels, next(_catalogue_versions))
+
+STATIC_CATALOGUES = {
+    "US": [(1, "US Product 1", 10.0), (2, "US Product 2", 20.0), (3, "US Product 3", 30.0)],
+    "UK": [(1, "UK Product 1", 12.0), (2, "UK Product 2", 18.0), (3, "UK Product 3", 28.0)],
+    "EU": [],
 }
 
+def _static_catalogue(rows) -> Catalogue:
+    b = CatalogueBuilder()
+    for pid, name, price in rows:
+        b.add(pid, name, price, True)
+    return b.build()
+
+catalogues = {region: _static_catalogue(rows) for region, rows in STATIC_CATALOGUES.items()}
+
+_PRICE_STRIP = re.compile(r"[^0-9.]")
+# Decimal comma -> dot and common currency/space noise dropped in one C-level pass
+_PRICE_TRANS = str.maketrans({",": ".", "$": None, "€": None, "£": None, " ": None, "\t": None, "\xa0": None})
+_PRICE_FAST = re.compile(r"\d+(?:\.\d+)?")
+_OOS_TOKENS = ("out",)
+
+# Pricelists repeat a handful of price/stock strings across thousands of rows, so
+# memoizing the per-cell normalizers turns most cells into a single dict hit.
+@lru_cache(maxsize=4096)
 def parse_price(val: str) -> float:
-    v = (val or "").strip().replace(",", ".")
-    v = re.sub(r"[^0-9.]", "", v)
+    v = val.translate(_PRICE_TRANS) if val else ""
+    if not _PRICE_FAST.fullmatch(v):  # "€ 23,00" is clean after translate and skips the regex
+        v = _PRICE_STRIP.sub("", v)
     try:
         return round(float(v), 2) if v else 0.0
     except Exception:
         return 0.0
 
-def availability_label(s: str) -> str:
-    s = (s or "").strip().lower()
-    if "out" in s: return "Out Of Stock"
-    if "in" in s or "stock" in s: return "In Stock"
-    return s.title() if s else "In Stock"
-
-def load_eu_from_csv_text(text: str) -> int:
-    items = {}; next_id = 1
-    reader = csv.DictReader(StringIO(text))
-    for row in reader:
-        name = (row.get("name") or row.get("Name") or "").strip()
+@lru_cache(maxsize=256)
+def is_in_stock(s: str) -> bool:
+    """Anything not marked out of stock (including a blank cell) counts as available."""
+    s = s.lower() if s else ""
+    return not any(t in s for t in _OOS_TOKENS)
+
+def publish_eu(items: CatalogueBuilder):
+    catalogues["EU"] = items.build()
+
+def load_eu_from_csv_lines(lines) -> int:
+    # Plain csv.reader rows (no dict per row) through the same column-index parser as sheets
+    return load_eu_from_rows(csv.reader(lines))
+
+HEADER_ALIASES = {
+    "name": ("name", "product", "item"),
+    "price": ("price", "cost", "amount"),
+    "stock": ("stock", "availability"),
+    "id": ("id",),
+}
+
+def coerce_pid(val, default: int) -> int:
+    # Sheet cells arrive typed: accept whole positive numbers, never bools or fractions like 3.7
+    if type(val) is int or (type(val) is float and val.is_integer()):
+        return int(val) if val > 0 else default
+    v = str(val).strip() if val is not None else ""
+    return int(v) if v.isdigit() else default
+
+def header_columns(row):
+    """(name, price, stock, id) indexes from a header row, or None if it isn't one."""
+    hmap = {str(c).strip().lower(): i for i, c in enumerate(row) if c is not None}
+    found = {key: next((hmap[a] for a in aliases if a in hmap), None)
+             for key, aliases in HEADER_ALIASES.items()}
+    if found["name"] is None: return None
+    return found["name"], found["price"], found["stock"], found["id"]
+
+# Header-less sheets use the fixed layout: A=name, B=price, C=stock, no id column
+DEFAULT_COLUMNS = (0, 1, 2, None)
+
+def load_eu_from_rows(rows_iter) -> int:
+    """Parse streamed sheet rows (blank cells as None or "") into the EU catalogue."""
+    first = next(rows_iter, None)
+    if first is None: return 0
+    # No header means the first row is a sheet title ("New products"); it is skipped either way
+    cols = header_columns(first) or DEFAULT_COLUMNS
+    # Missing columns point at a blank cell past the first row's width (so never a real column
+    # such as an unmapped "status" or SKU); short rows get padded up to it and the rare row wider
+    # than that is cut back, so the hot loop indexes rows directly with no per-cell checks.
+    blank = max(len(first), 1 + max(i for i in cols if i is not None))
+    name_idx, price_idx, stock_idx, id_idx = (blank if i is None else i for i in cols)
+    pad = (None,) * (blank + 1)
+    items = CatalogueBuilder(); next_id = 1
+    add, price_of, stock_of = items.add, parse_price, is_in_stock
+    for r in rows_iter:
+        if not r: continue
+        if len(r) <= blank: r = (*r, *pad[len(r):])
+        elif r[blank]: r = (*r[:blank], None)
+        nm = r[name_idx]
+        if nm is None: continue
+        name = nm.strip() if type(nm) is str else str(nm).strip()
         if not name: continue
-        pid = int(row.get("id")) if (row.get("id") and str(row["id"]).isdigit()) else next_id; next_id += (pid == next_id)
-        price = parse_price(row.get("price") or row.get("Price") or "0")
-        stock = availability_label(row.get("stock") or row.get("Stock") or "")
-        items[pid] = {"name": name, "price": price, "stock": stock}
-    catalogues["EU"] = dict(sorted(items.items(), key=lambda kv: kv[0]))
+        # Unnumbered rows count up on their own, as they always have: ids are what carts and
+        # buttons already in chats refer to, so an explicit id must not shift the rows after it.
+        pid = coerce_pid(r[id_idx], next_id)
+        if pid == next_id: next_id += 1
+        pv = r[price_idx]
+        price = price_of(pv if type(pv) is str else "" if pv is None else str(pv))
+        sv = r[stock_idx]
+        in_stock = stock_of(sv if type(sv) is str else "" if sv is None else str(sv))
+        add(pid, name, price, in_stock)
+    if not items: return 0  # empty or header-only sheet: keep serving the last good catalogue
+    publish_eu(items)
     return len(items)
 
+_ACTIVE_TAB = re.compile(rb'<workbookView\b[^>]*\bactiveTab="(\d+)"')
+
+def xlsx_active_tab(path: str) -> int:
+    """Index of the tab the workbook was saved on, which openpyxl exposes as wb.active."""
+    try:
+        with zipfile.ZipFile(path) as z:
+            m = _ACTIVE_TAB.search(z.read("xl/workbook.xml"))
+    except (KeyError, zipfile.BadZipFile):
+        return 0
+    return int(m.group(1)) if m else 0
+
+def calamine_rows(sheet):
+    """Sheet rows anchored at column A like openpyxl's. calamine already yields the leading
+    empty rows but starts each row at the first used column, so put the empty columns back."""
+    rows = sheet.iter_rows()
+    left = sheet.start[1] if sheet.start else 0
+    if not left: return rows
+    pad = (None,) * left
+    return ((*pad, *r) for r in rows)
+
+def load_eu_from_workbook(path: str, ext: str) -> int:
+    # Both backends read the active tab from A1, so the catalogue doesn't depend on what's installed
+    if CalamineWorkbook is not None:
+        # Rust-backed reader: several times faster than openpyxl, no per-cell objects, reads .xls too
+        wb = CalamineWorkbook.from_path(path)
+        try:
+            tab = xlsx_active_tab(path) if ext == ".xlsx" else 0
+            return load_eu_from_rows(calamine_rows(wb.get_sheet_by_index(tab)))
+        finally:
+            wb.close()
+    if openpyxl is None or ext == ".xls": return 0
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        # Read-only worksheets stream from the zip; keep it that way and only touch
+        # values via iter_rows tuples — ws.cell() lookups per cell are orders of magnitude slower.
+        assert wb.read_only, "EU sheet must be opened read_only"
+        # Sheets saved by some tools declare a bogus dimension (e.g. A1:XFD1048576) and every
+        # streamed row then gets padded out to it; drop it and read rows at their stored width.
+        ws.reset_dimensions()
+        return load_eu_from_rows(ws.iter_rows(values_only=True))
+    finally:
+        # read-only workbooks hold the file handle open until closed
+        wb.close()
+
 def load_eu_from_local(path: str) -> int:
-    if not path or not os.path.exists(path): return 0
+    if not path: return 0
     ext = os.path.splitext(path)[1].lower()
-    if ext == ".csv":
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return load_eu_from_csv_text(f.read())
-    elif ext in (".xlsx", ".xls"):
-        if openpyxl is None: return 0
-        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
-        ws = wb.active
-        rows_iter = ws.iter_rows(values_only=True)
-        items = {}; next_id = 1
-        # Skip first row title ("New products")
-        try: next(rows_iter)
-        except StopIteration: return 0
-        for r in rows_iter:
-            if not r: continue
-            name = str(r[0]).strip() if len(r) >= 1 and r[0] is not None else ""
-            if not name: continue
-            price = parse_price(str(r[1]).strip() if len(r) >= 2 and r[1] is not None else "")
-            stock = availability_label(str(r[2]).strip() if len(r) >= 3 and r[2] is not None else "")
-            items[next_id] = {"name": name, "price": price, "stock": stock}
-            next_id += 1
-        catalogues["EU"] = dict(sorted(items.items(), key=lambda kv: kv[0]))
-        return len(items)
+    try:
+        if ext == ".csv":
+            # utf-8-sig drops the BOM Excel puts on CSV exports, which would hide the "name" header
+            with open(path, "r", encoding="utf-8-sig", errors="ignore", newline="") as f:
+                return load_eu_from_csv_lines(f)
+        elif ext in (".xlsx", ".xls"):
+            return load_eu_from_workbook(path, ext)
+    except OSError:  # missing or unreadable (calamine raises a bare OSError)
+        pass
     return 0
 
-def load_eu_catalogue() -> int:
+EU_FETCH_TIMEOUT = aiohttp.ClientTimeout(total=15)
+EU_FETCH_CHUNK = 64 * 1024
+EU_PARSE_TIMEOUT = 60  # backstop so a wedged parser can't stall startup or /reload_eu
+
+class ChunkReader(RawIOBase):
+    """Blocking byte stream for the parser thread over an asyncio.Queue filled by the event loop.
+    None marks the end of the body; an exception instance aborts the parse."""
+    def __init__(self, chunks: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self.chunks = chunks
+        self.loop = loop
+        self.buf = memoryview(b"")
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            if self.eof: return 0  # readers may ask again after EOF; nothing more will arrive
+            fut = asyncio.run_coroutine_threadsafe(self.chunks.get(), self.loop)
+            try:
+                chunk = fut.result(EU_PARSE_TIMEOUT)
+            except BaseException:
+                fut.cancel(); raise
+            if chunk is None:
+                self.eof = True; return 0
+            if isinstance(chunk, BaseException): raise chunk
+            self.buf = memoryview(chunk)
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+async def load_eu_from_url(url: str) -> int:
+    # Download and parse overlap: chunks cross to the parser thread through a small bounded
+    # queue, so neither the raw body nor its decoded text is ever held in memory whole.
+    chunks = asyncio.Queue(maxsize=8)
+    reader = ChunkReader(chunks, asyncio.get_running_loop())
+    lines = TextIOWrapper(BufferedReader(reader), encoding="utf-8-sig", errors="replace", newline="")
+    parser = asyncio.ensure_future(asyncio.to_thread(load_eu_from_csv_lines, lines))
+
+    async def feed(item) -> bool:
+        # Wait for a free slot, unless the parser has stopped reading
+        put = asyncio.ensure_future(chunks.put(item))
+        await asyncio.wait((put, parser), return_when=asyncio.FIRST_COMPLETED)
+        if not put.done(): put.cancel()
+        return not parser.done()
+
+    try:
+        # Reuse the bot's pooled aiohttp session (keep-alive) rather than a throwaway one per reload
+        session = await bot.get_session()
+        async with session.get(url, timeout=EU_FETCH_TIMEOUT) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(EU_FETCH_CHUNK):
+                if not await feed(chunk): break
+    except BaseException as e:
+        # Never publish a half-downloaded list: hand the parser the error instead of EOF
+        while not chunks.empty(): chunks.get_nowait()
+        chunks.put_nowait(e if isinstance(e, Exception) else EOFError("EU download cancelled"))
+        if not isinstance(e, Exception): raise
+    else:
+        await feed(None)
+    return await asyncio.wait_for(parser, EU_PARSE_TIMEOUT)
+
+async def load_eu_catalogue() -> int:
+    # Parsing runs on a worker thread so a big sheet doesn't freeze other users' callbacks
     if EU_PRICELIST_PATH:
-        count = load_eu_from_local(EU_PRICELIST_PATH)
+        count = await asyncio.to_thread(load_eu_from_local, EU_PRICELIST_PATH)
         if count: return count
-    if EU_PRICELIST_CSV_URL and requests:
+    if EU_PRICELIST_CSV_URL:
         try:
-            resp = requests.get(EU_PRICELIST_CSV_URL, timeout=15); resp.raise_for_status()
-            return load_eu_from_csv_text(resp.text)
+            return await load_eu_from_url(EU_PRICELIST_CSV_URL)
         except Exception:
             return 0
     return 0
 
 # ---- Session state ----
-user_region = {}   # uid -> "US"/"UK"/"EU"
-user_page = {}     # uid -> page number per region (int)
-carts = {}         # uid -> [product_ids]
-step = {}          # uid -> awaiting_wallet/awaiting_shipping/contact_msg
-temp = {}          # uid -> dict
+# One TTL cache entry per user so abandoned sessions expire instead of accumulating
+# for the life of the worker, and each handler pays a single lookup for all its state.
+SESSION_MAX_USERS = 50_000
+SESSION_TTL = 24 * 3600   # browsing state: region, page, cart
+STEP_TTL = 3600           # in-flight checkout / contact prompts
+
+class Session:
+    __slots__ = ("region", "page", "cart", "subtotal", "version", "step", "step_until", "temp")
+
+    def __init__(self):
+        self.region = None       # "US"/"UK"/"EU"
+        self.page = 1            # product page within the region
+        self.cart = {}           # product id -> quantity, in order first added
+        self.subtotal = 0.0      # running cart subtotal ...
+        self.version = None      # ... priced against this catalogue version
+        self.step = None         # awaiting_wallet/awaiting_shipping/contact_msg
+        self.step_until = 0.0
+        self.temp = None         # checkout details collected across steps
+
+    def set_step(self, name):
+        self.step = name
+        self.step_until = monotonic() + STEP_TTL
+
+    def current_step(self):
+        if self.step is not None and monotonic() > self.step_until:
+            self.clear_step()
+        return self.step
+
+    def clear_step(self):
+        self.step = None
+        self.temp = None
+
+sessions = TTLCache(maxsize=SESSION_MAX_USERS, ttl=SESSION_TTL)  # uid -> Session
+
+def session(uid) -> Session:
+    # Re-inserting refreshes the TTL, so a session only expires after a day of inactivity
+    s = sessions.get(uid)
+    if s is None: s = Session()
+    sessions[uid] = s
+    return s
 
 # ---- UI helpers ----
-def main_menu_kb():
-    kb = types.InlineKeyboardMarkup(row_width=1)
-    kb.add(
+# Callback payloads; formats match what older keyboards already in chats send.
+region_cb = CallbackData("region", "code", "page", sep="_")
+page_cb = CallbackData("p", "region", "page", sep="_")
+add_cb = CallbackData("a", "pid", sep="_")
+rm_cb = CallbackData("rm", "pid", sep="_")
+older_cb = CallbackData("status_next", "before")
+status_cb = CallbackData("st", "oid", "status")
+legacy_page_cb = CallbackData("page", "region", "page", sep="_")  # pre-short-prefix buttons
+legacy_add_cb = CallbackData("add", "pid", sep="_")
+# Fixed texts are built once; the bot's default parse_mode is Markdown, so sends don't repeat it.
+START_TEXT = "Welcome. What would you like to do?"
+SETSTATUS_USAGE = ("Usage:\n`/setstatus <order_id> <pending|paid|shipped|delivered|canceled>`\n"
+                   "or reply to the order post with: `/setstatus <status>`")
+INVALID_STATUS_TEXT = f"Invalid status. Use: {', '.join(sorted(ORDER_STATUSES))}"
+REPLY_USAGE = "Usage: `/reply <msg_id> <your message>`"
+HELPADMIN_TEXT = (
+    "Admin controls:\n"
+    "• Inline buttons on order cards (Paid/Shipped/Delivered/Pending/Cancel)\n"
+    "• `/setstatus <order_id> <pending|paid|shipped|delivered|canceled>` or reply with `/setstatus <status>`\n"
+    "• `/reply <msg_id> <text>` to answer Contact Team tickets\n"
+    "• `/reload_eu` to refresh EU catalogue\n"
+)
+# Keyboards are memoized and shared between sends, so never mutate a returned markup.
+def main_menu_buttons():
+    return (
         types.InlineKeyboardButton("🛒 Place New Order", callback_data="menu_new"),
         types.InlineKeyboardButton("📦 Check Order Status", callback_data="menu_status"),
         types.InlineKeyboardButton("📩 Contact Team", callback_data="menu_contact"),
     )
+
+@lru_cache(maxsize=None)
+def main_menu_kb():
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(*main_menu_buttons())
     return kb
 
+@lru_cache(maxsize=None)
 def region_kb():
     kb = types.InlineKeyboardMarkup(row_width=3)
     kb.add(
-        types.InlineKeyboardButton("🇺🇸 U.S", callback_data="region_US_1"),
-        types.InlineKeyboardButton("🇬🇧 U.K", callback_data="region_UK_1"),
-        types.InlineKeyboardButton("🇪🇺 EU", callback_data="region_EU_1"),
+        types.InlineKeyboardButton("🇺🇸 U.S", callback_data=region_cb.new(code="US", page=1)),
+        types.InlineKeyboardButton("🇬🇧 U.K", callback_data=region_cb.new(code="UK", page=1)),
+        types.InlineKeyboardButton("🇪🇺 EU", callback_data=region_cb.new(code="EU", page=1)),
     )
     return kb
 
+@lru_cache(maxsize=None)
+def back_to_cart_kb():
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🛒 Back to Cart", callback_data="back_to_cart"))
+    return kb
+
+# (region, page) -> (catalogue, keyboard); an entry is reused only for the exact catalogue
+# object it was built from, so a reload between two reads can't mix old and new data
+_products_kbs = {}
+
 def products_kb(region, page: int):
-    items = catalogues.get(region, {})
+    cat = catalogues.get(region)
+    hit = _products_kbs.get((region, page))
+    if hit and hit[0] is cat:
+        return hit[1]
+    kb = _products_kb(cat, region, page)
+    if len(_products_kbs) >= 512:  # page comes from callback data; don't let it grow unbounded
+        _products_kbs.clear()
+    _products_kbs[(region, page)] = (cat, kb)
+    return kb
+
+def _products_kb(cat, region, page: int):
     kb = types.InlineKeyboardMarkup(row_width=1)
-    if not items:
+    if not cat or not cat.pids:
         kb.add(types.InlineKeyboardButton("⬅️ Back", callback_data="menu_new"))
         return kb
 
-    pids = sorted(items.keys())
+    pids = cat.pids
     start = (page - 1) * PAGE_SIZE
     end = start + PAGE_SIZE
-    page_slice = pids[start:end]
 
-    for pid in page_slice:
-        info = items[pid]
-        in_stock = "out" not in info.get("stock", "").lower()
-        stock_tag = "✅ In Stock" if in_stock else "❌ OOS"
-        label = f"{pid}. {info['name']} ({stock_tag}) — ${info['price']}"
-        kb.add(types.InlineKeyboardButton(label, callback_data=f"add_{pid}"))
+    for pid, label in zip(pids[start:end], cat.labels[start:end]):
+        kb.add(types.InlineKeyboardButton(label, callback_data=add_cb.new(pid=pid)))
 
     nav = []
     if start > 0:
-        nav.append(types.InlineKeyboardButton("« Prev", callback_data=f"page_{region}_{page-1}"))
+        nav.append(types.InlineKeyboardButton("« Prev", callback_data=page_cb.new(region=region, page=page - 1)))
     if end < len(pids):
-        nav.append(types.InlineKeyboardButton("Next »", callback_data=f"page_{region}_{page+1}"))
+        nav.append(types.InlineKeyboardButton("Next »", callback_data=page_cb.new(region=region, page=page + 1)))
     if nav: kb.row(*nav)
 
     kb.add(types.InlineKeyboardButton("🛒 View Cart / Checkout", callback_data="checkout"))
     kb.add(types.InlineKeyboardButton("⬅️ Back", callback_data="menu_new"))
     return kb
 
+def orders_kb(rows):
+    if len(rows) < ORDERS_PAGE_SIZE:
+        return main_menu_kb()
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(*main_menu_buttons())
+    kb.add(types.InlineKeyboardButton("Older orders »", callback_data=older_cb.new(before=rows[-1][0])))
+    return kb
+
+ORDER_LINE_TMPL = "• **#%s** | %s | $%s | %s | %s"
+
+def orders_text(title, rows):
+    # Unset statuses hold the schema default 'Pending', which isn't a STATUS_TITLES key
+    return title + "\n" + "\n".join([ORDER_LINE_TMPL % (oid, STATUS_TITLES.get(status) or status.title(),
+                                                          total, region, created)
+                                      for oid, status, total, region, created in rows])
+
+ADMIN_STATUS_ROWS = (
+    (("✅ Mark Paid", "paid"), ("📦 Shipped", "shipped")),
+    (("🚚 Delivered", "delivered"), ("⏳ Pending", "pending")),
+    (("🛑 Cancel", "canceled"),),
+)
+
+@lru_cache(maxsize=1024)
 def admin_status_kb(order_id):
     kb = types.InlineKeyboardMarkup(row_width=2)
-    kb.row(
-        types.InlineKeyboardButton("✅ Mark Paid", callback_data=f"st:{order_id}:paid"),
-        types.InlineKeyboardButton("📦 Shipped", callback_data=f"st:{order_id}:shipped"),
-    )
-    kb.row(
-        types.InlineKeyboardButton("🚚 Delivered", callback_data=f"st:{order_id}:delivered"),
-        types.InlineKeyboardButton("⏳ Pending", callback_data=f"st:{order_id}:pending"),
-    )
-    kb.row(types.InlineKeyboardButton("🛑 Cancel", callback_data=f"st:{order_id}:canceled"))
+    for row in ADMIN_STATUS_ROWS:
+        kb.row(*(types.InlineKeyboardButton(label, callback_data=status_cb.new(oid=order_id, status=status))
+                 for label, status in row))
     return kb
 
+# Fields in `orders` column order (id .. status), so a row tuple formats directly with %.
+ORDER_CARD_TMPL = (
+    "🧾 *Order* [#%s]\n"
+    "User: `%s`\n"
+    "Region: %s\n"
+    "Items: %s\n"
+    "Total: $%s USDT\n"
+    "Sender wallet: `%s`\n"
+    "Shipping:\n%s\n\n"
+    "Current status: *%s*"
+)
+CONTACT_CARD_TMPL = "📩 *New Message* [MSG-%s]\nFrom user: `%s`\n\n\"%s\""
+ORDER_RECEIVED_TMPL = "✅ Order *#%s* received.\nStatus: *Pending*"
+STATUS_UPDATE_TMPL = "📦 Update for order *#%s*: *%s*"
+# Payment prompt with the shop wallet baked in once; filled with (region, items, total)
+PAYMENT_TMPL = (
+    "Your order (%s): %s\n"
+    "Total: *$%s USDT*\n\n"
+    "Send payment to:\n`" + WALLET_ADDRESS.replace("%", "%%") + "`\n\n"
+    "Reply with the *crypto address you will send from*."
+)
+
+def _brace_escape(v):
+    return str(v).replace("{", "{{").replace("}", "}}")
+
+def order_card_template(user_id, region, products, total, user_wallet, shipping):
+    """Order card with `{oid}` and `{status}` left as str.format placeholders."""
+    return ORDER_CARD_TMPL % ("{oid}", user_id, _brace_escape(region), _brace_escape(products),
+                              total, _brace_escape(user_wallet), _brace_escape(shipping), "{status}")
+
 def order_card_text(row):
-    oid, user_id, region, products, total, user_wallet, shipping, status, created_at = row
-    return (
-        f"🧾 *Order* [#{oid}]\n"
-        f"User: `{user_id}`\n"
-        f"Region: {region}\n"
-        f"Items: {products}\n"
-        f"Total: ${total} USDT\n"
-        f"Sender wallet: `{user_wallet}`\n"
-        f"Shipping:\n{shipping}\n\n"
-        f"Current status: *{status}*"
-    )
+    return ORDER_CARD_TMPL % row[:8]
 
 # ---- Cart helpers ----
-def cart_counts(uid):
-    counts = {}
-    for pid in carts.get(uid, []):
-        counts[pid] = counts.get(pid, 0) + 1
-    return counts
-
-def compute_totals(uid, region):
-    base = sum(catalogues[region][pid]["price"] for pid in carts.get(uid, []))
+# A cart keeps a running subtotal priced against one catalogue snapshot (`version`).
+# If the catalogue is reloaded or the user switches region, the subtotal is re-summed once.
+def cart_add(s, cat, i):
+    if not s.cart:
+        s.subtotal, s.version = 0.0, cat.version
+    pid = cat.pids[i]
+    s.cart[pid] = s.cart.get(pid, 0) + 1
+    if s.version == cat.version:
+        s.subtotal = round(s.subtotal + cat.prices[i], 2)
+
+def cart_remove(s, cat, pid):
+    qty = s.cart.get(pid)
+    if not qty: return
+    if qty > 1: s.cart[pid] = qty - 1
+    else: del s.cart[pid]
+    i = cat.index.get(pid) if cat else None
+    if i is not None and s.version == cat.version:
+        s.subtotal = round(s.subtotal - cat.prices[i], 2)
+    else:
+        s.version = None  # priced against another snapshot: let compute_totals re-sum
+
+def cart_clear(s):
+    s.cart = {}; s.subtotal = 0.0; s.version = None
+
+def cart_items(s):
+    """Cart as the comma-separated pid list stored on the order, one entry per unit."""
+    return ", ".join(map(str, chain.from_iterable(map(repeat, s.cart, s.cart.values()))))
+
+def compute_totals(s, region):
+    cat = catalogues[region]
+    if s.cart and s.version != cat.version:
+        prices, index = cat.prices, cat.index
+        s.subtotal = round(sum(prices[index[pid]] * qty for pid, qty in s.cart.items() if pid in index), 2)
+        s.version = cat.version
+    base = s.subtotal if s.cart else 0.0
     final_total = round(base * (1.0 + MARKUP_RATE) + SHIPPING_FEE, 2)
-    return round(base, 2), final_total
+    return base, final_total
 
-def cart_text(uid, region):
-    counts = cart_counts(uid)
+def cart_text(s, region):
+    counts = s.cart
     if not counts:
         return "Your cart is empty."
     lines = []
+    cat = catalogues[region]
     for pid, qty in counts.items():
-        item = catalogues[region].get(pid, {})
-        price = item.get("price", 0)
-        lines.append(f"• {qty} × {item.get('name','?')} — ${round(price*qty,2)}")
-    base, final_total = compute_totals(uid, region)
+        i = cat.index.get(pid)
+        name, price = (cat.names[i], cat.prices[i]) if i is not None else ("?", 0)
+        lines.append(f"• {qty} × {name} — ${round(price*qty,2)}")
+    base, final_total = compute_totals(s, region)
     return "Your cart:\n" + "\n".join(lines) + f"\n\nTotal: *${final_total} USDT*"
 
-def cart_kb(uid):
-    counts = cart_counts(uid)
+def cart_kb(s):
+    counts = s.cart
     kb = types.InlineKeyboardMarkup(row_width=2)
     # Remove buttons (one per unique item; removes a single unit)
     for pid in sorted(counts.keys())[:20]:
-        kb.insert(types.InlineKeyboardButton(f"➖ Remove {pid}", callback_data=f"rm_{pid}"))
+        kb.insert(types.InlineKeyboardButton(f"➖ Remove {pid}", callback_data=rm_cb.new(pid=pid)))
     if counts:
         kb.add(types.InlineKeyboardButton("🗑 Clear Cart", callback_data="clear_cart"))
         kb.add(types.InlineKeyboardButton("💳 Proceed to Payment", callback_data="proceed"))
     kb.add(types.InlineKeyboardButton("➕ Add More Items", callback_data="addmore"))
     return kb
 
+# ---- Outbound queue ----
+# Notifications that don't answer the current update are queued and paced below
+# Telegram's ~30 msg/s bot limit, so handlers never wait on the rate limiter.
+SEND_INTERVAL = 1 / 28
+SEND_DRAIN_TIMEOUT = 10  # seconds shutdown waits for queued sends
+SEND_MAX_ATTEMPTS = 5    # flood-wait retries per message before its fail_note is posted
+outbound: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+overflow_sends = set()   # sends that bypassed a full queue; held so they aren't GC'd mid-flight
+
+def enqueue(chat_id, text, markup=None, fail_note=None):
+    """Queue a send; `fail_note` is posted to the admin group if delivery fails."""
+    try:
+        outbound.put_nowait((chat_id, text, markup, fail_note))
+    except asyncio.QueueFull:
+        task = asyncio.create_task(deliver(chat_id, text, markup, fail_note))
+        overflow_sends.add(task)
+        task.add_done_callback(overflow_sends.discard)
+
+async def deliver(chat_id, text, markup=None, fail_note=None, plain=False):
+    for _ in range(SEND_MAX_ATTEMPTS):
+        try:
+            # entities=[] switches off the bot's default Markdown for this send
+            await bot.send_message(chat_id, text, reply_markup=markup, entities=[] if plain else None)
+            return
+        except RetryAfter as e:
+            await asyncio.sleep(e.timeout)
+        except CantParseEntities:
+            # User-typed text (e.g. "my_order") can break legacy Markdown; send it unformatted instead
+            plain = True
+        except Exception:
+            log.warning("Could not deliver message to %s", chat_id, exc_info=True)
+            break
+    else:
+        log.warning("Gave up delivering message to %s after %d attempts", chat_id, SEND_MAX_ATTEMPTS)
+    if fail_note:
+        try: await bot.send_message(ADMIN_GROUP_ID, fail_note)
+        except Exception: pass
+
+async def sender_worker():
+    while True:
+        chat_id, text, markup, fail_note = await outbound.get()
+        try:
+            await deliver(chat_id, text, markup, fail_note)
+        finally:
+            outbound.task_done()
+        await asyncio.sleep(SEND_INTERVAL)
+
+# ---- Callback routing ----
+# One catch-all handler resolves callbacks by exact data, then by the CallbackData prefix
+# before the first ':' or '_' — a dict hit instead of aiogram running every registered
+# filter in turn. Structured payloads are parsed once and passed as `callback_data`.
+CALLBACK_EXACT = {}
+CALLBACK_PREFIX = {}
+
+def on_callback(key):
+    """Register for an exact callback string, or for every payload of a CallbackData factory."""
+    def register(handler):
+        if isinstance(key, CallbackData): CALLBACK_PREFIX[key.prefix] = (handler, key)
+        else: CALLBACK_EXACT[key] = handler
+        return handler
+    return register
+
+@dp.callback_query_handler()
+async def route_callback(call: types.CallbackQuery):
+    data = call.data or ""
+    handler = CALLBACK_EXACT.get(data)
+    if handler is not None:
+        await handler(call); return
+    entry = CALLBACK_PREFIX.get(data.partition(":")[0]) or CALLBACK_PREFIX.get(data.partition("_")[0])
+    try:
+        handler, factory = entry
+        callback_data = factory.parse(data)
+    except (TypeError, ValueError):
+        await call.answer(); return
+    await handler(call, callback_data)
+
 # ---- Customer handlers ----
 @dp.message_handler(commands=["start"])
 async def cmd_start(msg: types.Message):
-    await msg.answer("Welcome. What would you like to do?", reply_markup=main_menu_kb())
+    await msg.answer(START_TEXT, reply_markup=main_menu_kb())
 
-@dp.callback_query_handler(lambda c: c.data == "menu_new")
+@on_callback("menu_new")
 async def menu_new(call: types.CallbackQuery):
-    uid = call.from_user.id
-    carts[uid] = []
-    temp.pop(uid, None)
-    user_page[uid] = 1
+    s = session(call.from_user.id)
+    cart_clear(s); s.clear_step()
+    s.page = 1
     await call.message.edit_text("Choose your region:", reply_markup=region_kb())
 
-@dp.callback_query_handler(lambda c: c.data == "menu_status")
+@on_callback("menu_status")
 async def menu_status(call: types.CallbackQuery):
     uid = call.from_user.id
-    rows = get_user_orders(uid, limit=5)
+    rows = await get_user_orders(uid, limit=ORDERS_PAGE_SIZE)
     if not rows:
         await call.message.edit_text("No orders found.", reply_markup=main_menu_kb()); return
-    lines = [f"• **#{oid}** | {status.title()} | ${total} | {region} | {created}"
-             for (oid, status, total, region, created) in rows]
-    await call.message.edit_text("Recent orders:\n" + "\n".join(lines), reply_markup=main_menu_kb())
+    await call.message.edit_text(orders_text("Recent orders:", rows), reply_markup=orders_kb(rows))
 
-@dp.callback_query_handler(lambda c: c.data == "menu_contact")
-async def menu_contact(call: types.CallbackQuery):
+@on_callback(older_cb)
+async def menu_status_older(call: types.CallbackQuery, callback_data: dict):
     uid = call.from_user.id
-    step[uid] = "contact_msg"
+    before_id = int(callback_data["before"])
+    rows = await get_user_orders(uid, limit=ORDERS_PAGE_SIZE, before_id=before_id)
+    if not rows:
+        await call.answer("No older orders."); return
+    await call.message.edit_text(orders_text("Older orders:", rows), reply_markup=orders_kb(rows))
+
+@on_callback("menu_contact")
+async def menu_contact(call: types.CallbackQuery):
+    session(call.from_user.id).set_step("contact_msg")
     await call.message.edit_text(
         "Type the message you want to send to the team.\n\n"
         "_They will reply via the bot; you cannot DM them directly._"
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith("region_"))
-async def choose_region(call: types.CallbackQuery):
-    _, region, page = call.data.split("_")
-    uid = call.from_user.id
-    user_region[uid] = region
-    user_page[uid] = int(page)
+@on_callback(region_cb)
+async def choose_region(call: types.CallbackQuery, callback_data: dict):
+    region, page = callback_data["code"], callback_data["page"]
+    region = sys.intern(region)  # one shared "EU"/"US"/"UK" object across all sessions
+    s = session(call.from_user.id)
+    s.region = region
+    s.page = int(page)
     await call.message.edit_text(
         f"Selected region: *{region}*\nPick your products:",
         reply_markup=products_kb(region, int(page))
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith("page_"))
-async def paginate(call: types.CallbackQuery):
-    _, region, page = call.data.split("_")
-    uid = call.from_user.id
-    user_page[uid] = int(page)
+@on_callback(page_cb)
+@on_callback(legacy_page_cb)
+async def paginate(call: types.CallbackQuery, callback_data: dict):
+    region, page = callback_data["region"], callback_data["page"]
+    session(call.from_user.id).page = int(page)
     await call.message.edit_text(
         f"Selected region: *{region}*\nPick your products:",
         reply_markup=products_kb(region, int(page))
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith("add_"))
-async def add_item(call: types.CallbackQuery):
-    uid = call.from_user.id
-    region = user_region.get(uid)
+@on_callback(add_cb)
+@on_callback(legacy_add_cb)
+async def add_item(call: types.CallbackQuery, callback_data: dict):
+    s = session(call.from_user.id)
+    region = s.region
     if not region:
         await call.answer("Choose region first", show_alert=True); return
-    pid = int(call.data.split("_")[1])
-    item = catalogues.get(region, {}).get(pid)
-    if not item:
+    pid = int(callback_data["pid"])
+    cat = catalogues.get(region)
+    i = cat.index.get(pid) if cat else None
+    if i is None:
         await call.answer("Item not found on this page.", show_alert=True); return
-    if "out" in item.get("stock","").lower():
+    if not cat.in_stock[i]:
         await call.answer("That item is currently out of stock.", show_alert=True); return
-    carts.setdefault(uid, []).append(pid)
-    base, _ = compute_totals(uid, region)
+    cart_add(s, cat, i)
+    base, _ = compute_totals(s, region)
     await call.answer(f"Added. Subtotal: ${base}")
 
-@dp.callback_query_handler(lambda c: c.data == "checkout")
+@on_callback("checkout")
 async def checkout(call: types.CallbackQuery):
-    uid = call.from_user.id
-    region = user_region.get(uid)
+    s = session(call.from_user.id)
+    region = s.region
     if not region:
         await call.answer("Choose region first", show_alert=True); return
-    await call.message.edit_text(cart_text(uid, region), reply_markup=cart_kb(uid))
+    await call.message.edit_text(cart_text(s, region), reply_markup=cart_kb(s))
 
-@dp.callback_query_handler(lambda c: c.data.startswith("rm_"))
-async def remove_item(call: types.CallbackQuery):
-    uid = call.from_user.id
-    region = user_region.get(uid)
+@on_callback(rm_cb)
+async def remove_item(call: types.CallbackQuery, callback_data: dict):
+    s = session(call.from_user.id)
+    region = s.region
     if not region:
         await call.answer("Choose region first", show_alert=True); return
-    pid = int(call.data.split("_")[1])
-    if pid in carts.get(uid, []):
-        carts[uid].remove(pid)
-    await call.message.edit_text(cart_text(uid, region), reply_markup=cart_kb(uid))
+    pid = int(callback_data["pid"])
+    cart_remove(s, catalogues.get(region), pid)
+    await call.message.edit_text(cart_text(s, region), reply_markup=cart_kb(s))
 
-@dp.callback_query_handler(lambda c: c.data == "clear_cart")
+@on_callback("clear_cart")
 async def clear_cart(call: types.CallbackQuery):
-    uid = call.from_user.id
-    carts[uid] = []
-    region = user_region.get(uid)
-    await call.message.edit_text(cart_text(uid, region), reply_markup=cart_kb(uid))
+    s = session(call.from_user.id)
+    cart_clear(s)
+    await call.message.edit_text(cart_text(s, s.region), reply_markup=cart_kb(s))
 
-@dp.callback_query_handler(lambda c: c.data == "addmore")
+@on_callback("addmore")
 async def add_more(call: types.CallbackQuery):
-    uid = call.from_user.id
-    region = user_region.get(uid)
-    page = user_page.get(uid, 1)
+    s = session(call.from_user.id)
+    region = s.region
     await call.message.edit_text(
         f"Selected region: *{region}*\nPick your products:",
-        reply_markup=products_kb(region, page)
+        reply_markup=products_kb(region, s.page)
     )
 
-@dp.callback_query_handler(lambda c: c.data == "proceed")
+@on_callback("proceed")
 async def proceed_to_payment(call: types.CallbackQuery):
-    uid = call.from_user.id
-    region = user_region.get(uid)
-    if not carts.get(uid):
+    s = session(call.from_user.id)
+    region = s.region
+    if not s.cart:
         await call.answer("Cart is empty.", show_alert=True); return
-    base, final_total = compute_totals(uid, region)
-    items = ", ".join(str(i) for i in carts[uid])
-    temp[uid] = {"region": region, "items": items, "base_sum": base, "final_total": final_total}
-    step[uid] = "awaiting_wallet"
+    base, final_total = compute_totals(s, region)
+    items = cart_items(s)
+    s.set_step("awaiting_wallet")
+    s.temp = {"region": region, "items": items, "base_sum": base, "final_total": final_total}
 
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("🛒 Back to Cart", callback_data="back_to_cart"))
-    await call.message.edit_text(
-        f"Your order ({region}): {items}\n"
-        f"Total: *${final_total} USDT*\n\n"
-        f"Send payment to:\n`{WALLET_ADDRESS}`\n\n"
-        "Reply with the *crypto address you will send from*.",
-        reply_markup=kb
-    )
+    await call.message.edit_text(PAYMENT_TMPL % (region, items, final_total), reply_markup=back_to_cart_kb())
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_cart")
+@on_callback("back_to_cart")
 async def back_to_cart(call: types.CallbackQuery):
-    uid = call.from_user.id
-    region = user_region.get(uid)
-    step.pop(uid, None)  # back out of payment step
-    await call.message.edit_text(cart_text(uid, region), reply_markup=cart_kb(uid))
+    s = session(call.from_user.id)
+    s.clear_step()  # back out of payment step
+    await call.message.edit_text(cart_text(s, s.region), reply_markup=cart_kb(s))
 
-@dp.message_handler(lambda m: True, content_types=types.ContentTypes.TEXT)
-async def collect_steps(msg: types.Message):
+# ---- Conversation steps ----
+# Free-text replies are routed by the user's pending step; most messages have none.
+async def step_contact(msg: types.Message, s: Session):
+    text = msg.text.strip()
+    if len(text) < 2:
+        await msg.answer("Please write a bit more."); return
     uid = msg.from_user.id
-    # Contact Team
-    if step.get(uid) == "contact_msg":
-        text = msg.text.strip()
-        if len(text) < 2:
-            await msg.answer("Please write a bit more."); return
-        msg_id = insert_message(uid, text)
-        await bot.send_message(ADMIN_GROUP_ID, f"📩 *New Message* [MSG-{msg_id}]\nFrom user: `{uid}`\n\n\"{text}\"")
-        step.pop(uid, None)
-        await msg.answer("✅ Message sent. The team will reply here via the bot.", reply_markup=main_menu_kb())
-        return
-
-    # Payment flow: wallet -> shipping
-    if step.get(uid) == "awaiting_wallet":
-        temp.setdefault(uid, {})["user_wallet"] = msg.text.strip()
-        step[uid] = "awaiting_shipping"
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🛒 Back to Cart", callback_data="back_to_cart"))
-        await msg.answer("✅ Wallet noted.\nNow send your *shipping address* (one message).", reply_markup=kb)
-        return
-
-    if step.get(uid) == "awaiting_shipping":
-        shipping = msg.text.strip()
-        data = temp.get(uid, {})
-        region = data.get("region"); items = data.get("items")
-        base_sum = data.get("base_sum"); final_total = data.get("final_total")
-        user_wallet = data.get("user_wallet")
-        if not (region and items and base_sum is not None and final_total is not None and user_wallet):
-            await msg.answer("Session error. Please /start again.")
-            step.pop(uid, None); temp.pop(uid, None); return
-
-        order_id = insert_order(uid, region, items, final_total, user_wallet, shipping)
-
-        await msg.answer(
-            f"✅ Order *#{order_id}* received.\nStatus: *Pending*",
-            reply_markup=main_menu_kb()
-        )
-
-        row = get_order(order_id)
-        await bot.send_message(ADMIN_GROUP_ID, order_card_text(row), reply_markup=admin_status_kb(order_id))
-
-        carts[uid] = []
-        step.pop(uid, None); temp.pop(uid, None)
-        return
+    msg_id = await insert_message(uid, text)
+    enqueue(ADMIN_GROUP_ID, CONTACT_CARD_TMPL % (msg_id, uid, text),
+            fail_note=f"FYI: Could not post ticket MSG-{msg_id} from user `{uid}`.")
+    s.clear_step()
+    await msg.answer("✅ Message sent. The team will reply here via the bot.", reply_markup=main_menu_kb())
+
+# Payment flow: wallet -> shipping
+async def step_wallet(msg: types.Message, s: Session):
+    s.set_step("awaiting_shipping")
+    if s.temp is None: s.temp = {}
+    s.temp["user_wallet"] = msg.text.strip()
+    await msg.answer("✅ Wallet noted.\nNow send your *shipping address* (one message).", reply_markup=back_to_cart_kb())
+
+async def step_shipping(msg: types.Message, s: Session):
+    uid = msg.from_user.id
+    shipping = msg.text.strip()
+    data = s.temp or {}
+    region = data.get("region"); items = data.get("items")
+    base_sum = data.get("base_sum"); final_total = data.get("final_total")
+    user_wallet = data.get("user_wallet")
+    if not (region and items and base_sum is not None and final_total is not None and user_wallet):
+        await msg.answer("Session error. Please /start again.")
+        s.clear_step(); return
+
+    row = await insert_order(uid, region, items, final_total, user_wallet, shipping)
+    order_id = row[0]
+
+    await msg.answer(ORDER_RECEIVED_TMPL % order_id, reply_markup=main_menu_kb())
+
+    enqueue(ADMIN_GROUP_ID, order_card_text(row), admin_status_kb(order_id),
+            fail_note=f"FYI: Could not post the card for order #{order_id}.")
+
+    cart_clear(s)
+    s.clear_step()
+
+TEXT_HANDLERS = {
+    "contact_msg": step_contact,
+    "awaiting_wallet": step_wallet,
+    "awaiting_shipping": step_shipping,
+}
+
+def pending_text_step(msg: types.Message):
+    """Filter: hand the session and step handler to collect_steps so it needn't look them up again."""
+    s = sessions.get(msg.from_user.id)
+    handler = s and TEXT_HANDLERS.get(s.current_step())
+    return {"s": s, "step_handler": handler} if handler else False
+
+# Filtering on the step (rather than matching every text) lets messages from users with no
+# pending step fall through to the command handlers registered below.
+@dp.message_handler(pending_text_step, chat_type=types.ChatType.PRIVATE, content_types=types.ContentTypes.TEXT)
+async def collect_steps(msg: types.Message, s: Session, step_handler):
+    sessions[msg.from_user.id] = s  # refresh the idle TTL, as session() does
+    await step_handler(msg, s)
 
 # ---- Admin area ----
-def is_admin_group(message: types.Message) -> bool:
-    return message.chat.type in ("group", "supergroup") and message.chat.id == ADMIN_GROUP_ID
+# Resolved by the dispatcher's filters, so admin commands from any other chat never reach a handler
+ADMIN_CHAT = dict(chat_id=ADMIN_GROUP_ID, chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
 
-@dp.callback_query_handler(lambda c: c.data.startswith("st:"))
-async def cb_set_status(call: types.CallbackQuery):
+@on_callback(status_cb)
+async def cb_set_status(call: types.CallbackQuery, callback_data: dict):
     if call.message.chat.id != ADMIN_GROUP_ID:
         await call.answer("Not allowed here.", show_alert=True); return
-    _, oid_str, status = call.data.split(":")
-    try: oid = int(oid_str)
-    except ValueError:
+    oid_str, status = callback_data["oid"], callback_data["status"]
+    if not oid_str.isdigit():
         await call.answer("Bad order id.", show_alert=True); return
+    oid = int(oid_str)
     status = status.lower()
     if status not in ORDER_STATUSES:
         await call.answer("Bad status.", show_alert=True); return
-    if not update_order_status(oid, status):
+    updated, row = await update_order_status_returning(oid, status)
+    if not updated:
         await call.answer("Order not found.", show_alert=True); return
-    row = get_order(oid)
-    try:
-        await call.message.edit_text(order_card_text(row), reply_markup=admin_status_kb(oid))
-    except Exception:
-        await bot.send_message(ADMIN_GROUP_ID, order_card_text(row), reply_markup=admin_status_kb(oid))
-    _, user_id, *_ = row
-    try: await bot.send_message(user_id, f"📦 Update for order *#{oid}*: *{status.title()}*")
-    except Exception: pass
-    await call.answer(f"Updated to {status.title()}")
+    user_id, card_template = row
+    card = card_template.format(oid=oid, status=status)
+    enqueue(user_id, STATUS_UPDATE_TMPL % (oid, STATUS_TITLES[status]),
+            fail_note=f"FYI: Could not notify user of order #{oid} (not reachable).")
+    # Card edit and callback ack are independent round-trips; overlap them
+    edited, _ = await asyncio.gather(
+        call.message.edit_text(card, reply_markup=admin_status_kb(oid)),
+        call.answer(f"Updated to {STATUS_TITLES[status]}"),
+        return_exceptions=True,
+    )
+    if isinstance(edited, Exception):
+        enqueue(ADMIN_GROUP_ID, card, admin_status_kb(oid))
 
-@dp.message_handler(commands=["setstatus"])
+@dp.message_handler(commands=["setstatus"], **ADMIN_CHAT)
 async def setstatus_cmd(msg: types.Message):
-    if not is_admin_group(msg): return
     args = msg.get_args().strip()
     order_id = None; new_status = None
-    ORDER_ID_RE = re.compile(r"#(\d+)")
     if args:
         parts = args.split(maxsplit=1)
         if len(parts) == 2 and parts[0].isdigit():
@@ -538,68 +1058,86 @@ async def setstatus_cmd(msg: types.Message):
             m = ORDER_ID_RE.search(src)
             if m: order_id = int(m.group(1)); new_status = parts[0].lower()
     if not order_id or not new_status:
-        await msg.reply("Usage:\n`/setstatus <order_id> <pending|paid|shipped|delivered|canceled>`\n"
-                        "or reply to the order post with: `/setstatus <status>`", parse_mode="Markdown"); return
+        await msg.reply(SETSTATUS_USAGE); return
     if new_status not in ORDER_STATUSES:
-        await msg.reply(f"Invalid status. Use: {', '.join(sorted(ORDER_STATUSES))}"); return
-    if not update_order_status(order_id, new_status):
+        await msg.reply(INVALID_STATUS_TEXT); return
+    updated, row = await update_order_status_returning(order_id, new_status)
+    if not updated:
         await msg.reply(f"Order #{order_id} not found."); return
-    row = get_order(order_id)
-    try:
-        await msg.reply(f"✅ Order #{order_id} → *{new_status.title()}*")
-        if msg.reply_to_message:
-            try: await msg.reply_to_message.edit_text(order_card_text(row), reply_markup=admin_status_kb(order_id))
-            except Exception: pass
-    except Exception: pass
-    _, user_id, *_ = row
-    try: await bot.send_message(user_id, f"📦 Update for order *#{order_id}*: *{new_status.title()}*")
-    except Exception: await msg.reply("FYI: Could not notify user (not reachable).")
-
-@dp.message_handler(commands=["reply"])
+    user_id, card_template = row
+    enqueue(user_id, STATUS_UPDATE_TMPL % (order_id, STATUS_TITLES[new_status]),
+            fail_note=f"FYI: Could not notify user of order #{order_id} (not reachable).")
+    calls = [msg.reply(f"✅ Order #{order_id} → *{STATUS_TITLES[new_status]}*")]
+    if msg.reply_to_message:
+        card = card_template.format(oid=order_id, status=new_status)
+        calls.append(msg.reply_to_message.edit_text(card, reply_markup=admin_status_kb(order_id)))
+    await asyncio.gather(*calls, return_exceptions=True)
+
+@dp.message_handler(commands=["reply"], **ADMIN_CHAT)
 async def reply_cmd(msg: types.Message):
-    if not is_admin_group(msg): return
     args = msg.get_args()
-    if not args: await msg.reply("Usage: `/reply <msg_id> <your message>`", parse_mode="Markdown"); return
+    if not args: await msg.reply(REPLY_USAGE); return
     parts = args.split(maxsplit=1)
     if len(parts) < 2: await msg.reply("Include both message id and text."); return
     try: msg_id = int(parts[0])
     except ValueError: await msg.reply("Message id must be a number."); return
     reply_text = parts[1]
-    rec = get_message(msg_id)
+    rec = await get_message(msg_id)
     if not rec: await msg.reply(f"Message MSG-{msg_id} not found."); return
     _, user_id, _, _, _ = rec
     try:
         await bot.send_message(user_id, f"📩 *Reply from Team:*\n{reply_text}")
-        mark_message_replied(msg_id)
+        await mark_message_replied(msg_id)
         await msg.reply(f"✅ Sent reply to user `{user_id}` for MSG-{msg_id}")
     except Exception as e:
         await msg.reply(f"Could not send reply to user `{user_id}`. Error: {e}")
 
-@dp.message_handler(commands=["reload_eu"])
+@dp.message_handler(commands=["reload_eu"], **ADMIN_CHAT)
 async def reload_eu_cmd(msg: types.Message):
-    if not is_admin_group(msg): return
-    count = load_eu_catalogue()
+    count = await load_eu_catalogue()
     await msg.reply(f"EU pricelist reloaded. Items: {count}" if count else
                     "Failed to load EU pricelist. Check EU_PRICELIST_PATH/CSV URL.")
 
-@dp.message_handler(commands=["helpadmin"])
+@dp.message_handler(commands=["helpadmin"], **ADMIN_CHAT)
 async def helpadmin_cmd(msg: types.Message):
-    if not is_admin_group(msg): return
-    await msg.reply(
-        "Admin controls:\n"
-        "• Inline buttons on order cards (Paid/Shipped/Delivered/Pending/Cancel)\n"
-        "• `/setstatus <order_id> <pending|paid|shipped|delivered|canceled>` or reply with `/setstatus <status>`\n"
-        "• `/reply <msg_id> <text>` to answer Contact Team tickets\n"
-        "• `/reload_eu` to refresh EU catalogue\n",
-        parse_mode="Markdown"
-    )
+    await msg.reply(HELPADMIN_TEXT)
 
 @dp.message_handler(commands=["chatid"])
 async def chatid(msg: types.Message):
     await msg.reply(f"Chat ID: {msg.chat.id}")
 
 # ---- Run ----
+async def on_startup(dp):
+    await init_db()
+    await load_eu_catalogue()
+    dp["sender_task"] = asyncio.create_task(sender_worker())
+    if WEBHOOK_HOST:
+        # Not deleted on shutdown: during a redeploy the new instance has already re-registered it
+        await bot.set_webhook(WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH, drop_pending_updates=True,
+                              secret_token=WEBHOOK_SECRET)
+
+async def on_shutdown(dp):
+    # Deliver what's still queued (order cards, tickets, notifications) before stopping the sender
+    try:
+        await asyncio.wait_for(asyncio.gather(outbound.join(), *overflow_sends), SEND_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("Shutdown: dropped %d queued messages", outbound.qsize())
+    dp["sender_task"].cancel()
+    await pool.close()
+
+@web.middleware
+async def check_webhook_secret(request, handler):
+    # aiogram 2 doesn't check Telegram's secret header itself; reject anything without it
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        raise web.HTTPUnauthorized()
+    return await handler(request)
+
 if __name__ == "__main__":
-    init_db()
-    load_eu_catalogue()
-    executor.start_polling(dp, skip_updates=True)
+    if WEBHOOK_HOST:
+        # Telegram pushes each update as it happens instead of the bot long-polling getUpdates
+        webhook = executor.set_webhook(dp, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown,
+                                       web_app=web.Application(middlewares=[check_webhook_secret]))
+        webhook.run_app(host="0.0.0.0", port=WEBHOOK_PORT)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
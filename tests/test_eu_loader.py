@@ -0,0 +1,105 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("API_TOKEN", "123456:TEST")
+os.environ.setdefault("ADMIN_GROUP_ID", "-100")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def load_csv(text):
+    count = main.load_eu_from_csv_lines(text.splitlines(True))
+    cat = main.catalogues["EU"]
+    return count, dict(zip(cat.pids, cat.names))
+
+
+def test_unnumbered_rows_keep_their_own_count():
+    count, items = load_csv("id,name,price,stock\n5,A,1,in\n,D,2,in\n,E,3,out\n")
+    assert count == 3
+    assert items == {1: "D", 2: "E", 5: "A"}
+
+
+def test_empty_sheet_keeps_last_catalogue():
+    load_csv("name,price,stock\nA,1,in\n")
+    before = main.catalogues["EU"]
+    assert main.load_eu_from_csv_lines(["name,price,stock\n"]) == 0
+    assert main.load_eu_from_csv_lines(["New products\n"]) == 0
+    assert main.load_eu_from_csv_lines([]) == 0
+    assert main.catalogues["EU"] is before
+
+
+def test_coerce_pid_accepts_only_whole_positive_ids():
+    assert main.coerce_pid(7, 1) == 7
+    assert main.coerce_pid(7.0, 1) == 7
+    assert main.coerce_pid(" 12 ", 1) == 12
+    for bad in (True, False, 3.7, 0, -2, 0.0, None, "", "x1", "3.7"):
+        assert main.coerce_pid(bad, 99) == 99
+
+
+def test_unmapped_columns_are_never_read():
+    # D holds a SKU and the header has no id column: ids must still count from 1
+    count, items = load_csv("New products\nA,1,in,1001\nB,2,out,1002\n")
+    assert items == {1: "A", 2: "B"}
+    count, items = load_csv("name,price\nA,1,out\n")
+    assert list(main.catalogues["EU"].in_stock) == [1]
+
+
+def test_csv_with_bom_keeps_its_header(tmp_path):
+    path = tmp_path / "eu.csv"
+    path.write_bytes("name,price,stock\nA,1.5,in stock\nB,2,out\n".encode("utf-8-sig"))
+    assert main.load_eu_from_local(str(path)) == 2
+    cat = main.catalogues["EU"]
+    assert cat.names == ["A", "B"] and list(cat.prices) == [1.5, 2.0] and list(cat.in_stock) == [1, 0]
+
+
+def test_status_column_is_not_read_as_stock():
+    load_csv("name,price,status\nA,1,out for review\n")
+    assert list(main.catalogues["EU"].in_stock) == [1]
+
+
+def load_workbook_with(backend, path, monkeypatch):
+    if backend == "openpyxl":
+        monkeypatch.setattr(main, "CalamineWorkbook", None)
+    count = main.load_eu_from_workbook(str(path), ".xlsx")
+    cat = main.catalogues["EU"]
+    return count, cat.pids, cat.names, list(cat.prices), list(cat.in_stock)
+
+
+@pytest.mark.parametrize("layout", ["plain", "offset", "column_b", "second_tab_active", "header"])
+def test_calamine_and_openpyxl_load_the_same_catalogue(layout, tmp_path, monkeypatch):
+    openpyxl = pytest.importorskip("openpyxl")
+    if main.CalamineWorkbook is None:
+        pytest.skip("python-calamine not installed")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    rows = [["New products"], ["A", 1.5, "in stock"], ["B", "2,00 €", "out of stock"], ["C", 3]]
+    if layout == "header":
+        rows = [["id", "name", "price", "stock"], [4, "A", 1, "in"], [None, "B", 2, "out"]]
+    if layout == "offset":
+        ws.cell(row=3, column=2, value="New products")  # data from B3: nothing in column A
+        ws.cell(row=4, column=2, value="X")
+        ws.cell(row=4, column=3, value=9)
+        ws.cell(row=5, column=1, value="A")
+        ws.cell(row=5, column=2, value=1)
+    elif layout == "column_b":
+        for r in rows: ws.append([None, *r])  # whole sheet shifted right: column A unused
+    else:
+        for r in rows: ws.append(r)
+    if layout == "second_tab_active":
+        other = wb.create_sheet("Notes")
+        other.append(["New products"])
+        other.append(["Z", 7, "in"])
+        wb.active = 1
+    path = tmp_path / "eu.xlsx"
+    wb.save(path)
+    calamine = load_workbook_with("calamine", path, monkeypatch)
+    assert calamine == load_workbook_with("openpyxl", path, monkeypatch)
+    expected = {"plain": ["A", "B", "C"], "offset": ["A"], "column_b": None,
+                "second_tab_active": ["Z"], "header": ["B", "A"]}[layout]
+    if expected is None:
+        assert calamine[0] == 0  # header-less sheets read names from column A, as they always have
+    else:
+        assert calamine[0] == len(expected) and calamine[2] == expected